@@ -23,30 +23,166 @@ stop_times.txt files are updated.'''
 import os
 import csv
 import sqlite3
-import codecs
-import random
+import math
 from operator import itemgetter
+import numpy as np
 import arcpy
 
+# Use numba to compile the numeric kernels if it's available.  Otherwise, they just run as regular python.
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
+    def njit(**kwargs):
+        return lambda func: func
+
 class CustomError(Exception):
     pass
 
 
+# Use a large write buffer for the output text files
+CSV_BUFFER_SIZE = 2**20
+
+# Mean radius of the earth in each of the units allowed for shape_dist_traveled
+EARTH_RADIUS = {
+    "METERS": 6371008.8,
+    "KILOMETERS": 6371.0088,
+    "MILES": 3958.7613,
+    "FEET": 20902259.8,
+    "YARDS": 6967419.9
+    }
+
+
+if numba_available:
+    @njit(cache=True, fastmath=True)
+    def get_cumulative_geodesic_distances(lats, lons, part_starts, radius):
+        '''Calculate the cumulative haversine distance along a sequence of WGS84 vertices. part_starts flags the first
+        vertex of each part of a multipart line, and the gap between parts is not counted.'''
+        out = np.zeros(lats.shape[0])
+        for i in range(1, lats.shape[0]):
+            if part_starts[i]:
+                out[i] = out[i - 1]
+                continue
+            lat1 = math.radians(lats[i - 1])
+            lat2 = math.radians(lats[i])
+            dlat = lat2 - lat1
+            dlon = math.radians(lons[i]) - math.radians(lons[i - 1])
+            a = math.sin(dlat / 2.0)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2.0)**2
+            out[i] = out[i - 1] + 2.0 * radius * math.asin(math.sqrt(min(a, 1.0)))
+        return out
+else:
+    def get_cumulative_geodesic_distances(lats, lons, part_starts, radius):
+        '''Calculate the cumulative haversine distance along a sequence of WGS84 vertices. part_starts flags the first
+        vertex of each part of a multipart line, and the gap between parts is not counted.'''
+        lat_rad = np.radians(lats)
+        lon_rad = np.radians(lons)
+        dlat = np.diff(lat_rad)
+        dlon = np.diff(lon_rad)
+        a = np.sin(dlat / 2.0)**2 + np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) * np.sin(dlon / 2.0)**2
+        segment_lengths = 2.0 * radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        segment_lengths[part_starts[1:]] = 0.0
+        return np.concatenate(([0.0], np.cumsum(segment_lengths)))
+
+
+def get_cumulative_planar_distances(xs, ys, part_starts):
+    '''Calculate the cumulative distance along a sequence of vertices in their native units. part_starts flags the
+    first vertex of each part of a multipart line, and the gap between parts is not counted, the same as measureOnLine.'''
+    segment_lengths = np.hypot(np.diff(xs), np.diff(ys))
+    segment_lengths[part_starts[1:]] = 0.0
+    return np.concatenate(([0.0], np.cumsum(segment_lengths)))
+
+
+@njit(cache=True)
+def make_nondecreasing(values):
+    '''Use pool adjacent violators to adjust an array of values in place to the closest non-decreasing sequence.
+    Returns True if any values had to be adjusted.'''
+    # Most shapes' stops measure in order already, so don't bother setting up the blocks for those
+    for i in range(1, values.shape[0]):
+        if values[i] < values[i - 1]:
+            break
+    else:
+        return False
+    block_sums = np.zeros(values.shape[0])
+    block_counts = np.zeros(values.shape[0], dtype=np.int64)
+    num_blocks = 0
+    adjusted = False
+    for i in range(values.shape[0]):
+        block_sums[num_blocks] = values[i]
+        block_counts[num_blocks] = 1
+        num_blocks += 1
+        # Merge the last two blocks as long as their averages are out of order
+        while num_blocks > 1 and \
+                block_sums[num_blocks - 2] * block_counts[num_blocks - 1] > \
+                block_sums[num_blocks - 1] * block_counts[num_blocks - 2]:
+            block_sums[num_blocks - 2] += block_sums[num_blocks - 1]
+            block_counts[num_blocks - 2] += block_counts[num_blocks - 1]
+            num_blocks -= 1
+            adjusted = True
+    i = 0
+    for block in range(num_blocks):
+        block_mean = block_sums[block] / block_counts[block]
+        for j in range(block_counts[block]):
+            values[i] = block_mean
+            i += 1
+    return adjusted
+
+
+def linear_reference_stops(polyline, stop_xys, stop_point, native_dists, geodesic_dists):
+    '''Find the geodesic distance along a shape to each of its stops, given in sequence order. Returns the list of
+    distances and whether the stops had to be adjusted because they didn't measure in sequence order.'''
+    # Measure each stop along the line in the line's native units, reusing the same point object
+    max_measure = polyline.length
+    measures = np.zeros(len(stop_xys))
+    prev_measure = 0.0
+    prev_xy = None
+    out_of_order = False
+    for i, (x, y) in enumerate(stop_xys):
+        stop_point.X = x
+        stop_point.Y = y
+        measure = polyline.measureOnLine(stop_point, use_percentage=False)
+        if measure < prev_measure:
+            # The stop snapped to a spot before the previous stop. This happens on routes that loop or backtrack on
+            # themselves, where the stop is on a later pass along the same road, so measure it again along only the
+            # rest of the line after the previous stop.
+            if prev_measure >= max_measure:
+                # The previous stop is already at the end of the line, so there's nowhere left to put this one.
+                measure = max_measure
+                if (x, y) != prev_xy:
+                    out_of_order = True
+            else:
+                polyline_segment = polyline.segmentAlongLine(prev_measure, max_measure, use_percentage=False)
+                segment_measure = polyline_segment.measureOnLine(stop_point, use_percentage=False)
+                if segment_measure > 0 or (x, y) == prev_xy:
+                    measure = prev_measure + segment_measure
+                # Otherwise the stop is nowhere along the rest of the line, so it really does belong before the
+                # previous stop. Keep the first measure and let the check below sort it out.
+        measures[i] = measure
+        prev_measure = measure
+        prev_xy = (x, y)
+
+    # Check if the stops came out in the right order. If they didn't, something is wrong with the user's input
+    # shape or the way it got linear referenced. Nudge the measures so they are in the right order anyway.
+    if make_nondecreasing(measures):
+        out_of_order = True
+
+    # Convert measure distance to geodesic shape_dist_traveled by interpolating between the distances already
+    # calculated for the shape's vertices
+    return np.interp(measures, native_dists, geodesic_dists).tolist(), out_of_order
+
+
+table_columns = {}  # {table name: tuple of column names}
 def get_table_columns(tablename):
     '''Get the columns from a SQL table'''
-    c.execute("PRAGMA table_info(%s)" % tablename)
-    table_info = c.fetchall()
-    columns = ()
-    for col in table_info:
-        columns = columns + (col[1],)
-    return columns
+    if tablename not in table_columns:
+        c.execute("PRAGMA table_info(%s)" % tablename)
+        table_columns[tablename] = tuple(col[1] for col in c.fetchall())
+    return table_columns[tablename]
 
 
-def get_trips_with_shape_id(shape):
-    tripsfetch = '''SELECT trip_id FROM trips where shape_id="%s";''' % shape
-    c.execute(tripsfetch)
-    trips = c.fetchall()
-    return [trip[0] for trip in trips]
+def encode_row(row):
+    '''Encode the strings in a row from a SQL table in utf-8 so python 2's csv module can write them'''
+    return [t.encode("utf-8") if isinstance(t, basestring) else t for t in row]
 
 
 def write_SQL_table_to_text_file(tablename, csvfile, columns):
@@ -65,17 +201,14 @@ def write_SQL_table_to_text_file(tablename, csvfile, columns):
         selectrowsstmt = "SELECT * FROM %s;" % tablename
         ct.execute(selectrowsstmt)
         
-        # Write each row to the csv file
-        for row in ct:
-            # Encode row in utf-8.
-            if ProductName == "ArcGISPro":
-                rowToWrite = tuple([t for t in row])
-            else:
-                rowToWrite = tuple([t.encode("utf-8") if isinstance(t, basestring) else t for t in row])
-            wr.writerow(rowToWrite)
+        # Write all the rows to the csv file, encoding in utf-8 if needed.
+        if ProductName == "ArcGISPro":
+            wr.writerows(ct)
+        else:
+            wr.writerows(encode_row(row) for row in ct)
 
     if ProductName == "ArcGISPro":
-        with codecs.open(csvfile, "wb", encoding="utf-8") as f:
+        with open(csvfile, "w", encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE) as f:
             WriteFile(f)
     else:         
         with open(csvfile, "wb") as f:
@@ -106,8 +239,9 @@ try:
     outTripsFile = os.path.join(outDir, 'trips_new.txt')
     outStopTimesFile = os.path.join(outDir, 'stop_times_new.txt')
 
-    # GTFS is in WGS coordinates
+    # GTFS is in WGS coordinates, so calculate distances along the earth's surface in the user's units
     WGSCoords = arcpy.SpatialReference(4326)
+    earth_radius = EARTH_RADIUS[units.upper()]
 
 
 # ----- Set some things up -----
@@ -132,19 +266,26 @@ tool. You have ArcGIS Pro version %s." % ArcVersion)
     # Connect to the SQL database
     conn = sqlite3.connect(SQLDbase)
     c = conn.cursor()
-
-    # Store some useful information
-    trip_shape_dict = {} # {trip_id: shape_id}
+    # Speed up the bulk reads and writes. These only last for this connection.
+    c.execute("PRAGMA synchronous = NORMAL;")
+    c.execute("PRAGMA temp_store = MEMORY;")
+    c.execute("PRAGMA cache_size = -65536;")
+
+    # Make sure the columns we look things up by are indexed. Step 1 should have already done this.
+    c.execute("CREATE INDEX IF NOT EXISTS stoptimes_index_tripIDs ON stop_times (trip_id);")
+    c.execute("CREATE INDEX IF NOT EXISTS trips_index_tripIDs ON trips (trip_id);")
     if update_existing:
-        for line in arcpy.da.SearchCursor(inShapes, ["shape_id"]):
-            for trip in get_trips_with_shape_id(line[0]):
-                trip_shape_dict[trip] = line[0]
-    else:
-        cts = conn.cursor()
-        tripsfetch = '''SELECT trip_id, shape_id FROM trips;'''
-        cts.execute(tripsfetch)
-        for trip in cts:
-            trip_shape_dict[trip[0]] = trip[1]
+        c.execute("CREATE INDEX IF NOT EXISTS shapes_index_shapeIDs ON shapes (shape_id, shape_pt_sequence);")
+    conn.commit()
+
+    # Store the calculated shape_dist_traveled values in a temporary SQL table so they can be joined to stop_times
+    c.execute('''CREATE TEMP TABLE stop_shape_dist (shape_id TEXT, stop_id TEXT, shape_dist_traveled REAL,
+        PRIMARY KEY (shape_id, stop_id));''')
+    # Look up the table columns now too. Older versions of python's sqlite3 module commit any open transaction
+    # before statements like these, and the changes we make to the SQL tables below must never be committed to
+    # the user's Step 1 database.
+    for tablename in ["trips", "shapes", "stop_times"]:
+        get_table_columns(tablename)
 
     numshapes = int(arcpy.management.GetCount(inShapes)[0])
     tenperc = 0.1 * numshapes
@@ -163,59 +304,98 @@ tool. You have ArcGIS Pro version %s." % ArcVersion)
             raise
 
 
-# ----- Generate the new shapes.txt file -----
+# ----- Generate the new shapes.txt file and linear reference the stops along the shapes -----
 
-    arcpy.AddMessage("Generating new shapes.txt file...")
+    arcpy.AddMessage("Generating new shapes.txt file and calculating shape_dist_traveled for stops...")
     arcpy.AddMessage("(This may take some time for datasets with a large number of shapes.)")
 
-    # Write to shapes.txt file
     try:
-        
+
         def WriteShapesFile(f):
             wr = csv.writer(f)
             # Write the headers
             if not update_existing:
                 wr.writerow(["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence", "shape_dist_traveled"])
 
-            # Use a Search Cursor and explode to points to get vertex info
-            shape_pt_seq = 1
-            shape_dist_traveled = 0
-            current_shape_id = None
-            previous_point = None
-            for row in arcpy.da.SearchCursor(inShapes, ["shape_id", "SHAPE@Y", "SHAPE@X"], explode_to_points=True):
-                shape_id, shape_pt_lat, shape_pt_lon = row
-                current_point = arcpy.Point(shape_pt_lon, shape_pt_lat)
-                if shape_id != current_shape_id:
-                    # Starting a new shape
-                    current_shape_id = shape_id
-                    shape_pt_seq = 1
-                    shape_dist_traveled = 0
-                else:
-                    # Create a line segment between the previous vertex and this one so we can calculate geodesic length
-                    line_segment = arcpy.Polyline(arcpy.Array([previous_point, current_point]), WGSCoords)
-                    shape_dist_traveled += line_segment.getLength("GEODESIC", units.upper())
- 
-                # Write row to shapes.txt file
-                if not update_existing:
-                    row_to_add = [shape_id, shape_pt_lat, shape_pt_lon, shape_pt_seq, shape_dist_traveled]
+            # Reuse a single point object for linear referencing the stops. The shapes and stops are both read in
+            # WGS84 coordinates, whatever their feature classes' spatial references are, so the point needs no
+            # spatial reference of its own.
+            stop_point = arcpy.Point()
+
+            progress = 0
+            perc = 10
+            for polyline, shape_id in arcpy.da.SearchCursor(inShapes, ["SHAPE@", "shape_id"], spatial_reference=WGSCoords):
+                # Print some progress indicators
+                progress += 1
+                if progress >= tenperc:
+                    arcpy.AddMessage(str(perc) + "% finished")
+                    perc += 10
+                    progress = 0
+
+                # Get the shape's vertices in order
+                lats = []
+                lons = []
+                part_starts = []  # True for the first vertex of each part
+                if polyline:
+                    for part in polyline:
+                        part_start = True
+                        for pt in part:
+                            lats.append(pt.Y)
+                            lons.append(pt.X)
+                            part_starts.append(part_start)
+                            part_start = False
+
+                # Get the stop_ids and coordinates for the stops on this shape as parallel lists in sequence order
+                shape_stops = sorted(stops_by_shape.get(shape_id, []), key=itemgetter(0))
+                stop_ids = [stop[1] for stop in shape_stops]
+                stop_xys = [stop[2] for stop in shape_stops]
+
+                if lats:
+                    # Calculate the geodesic distance along the shape to each vertex all at once
+                    lat_array = np.array(lats, dtype=np.float64)
+                    lon_array = np.array(lons, dtype=np.float64)
+                    part_start_array = np.array(part_starts, dtype=np.bool_)
+                    shape_dists = get_cumulative_geodesic_distances(lat_array, lon_array, part_start_array, earth_radius)
+
+                    # Write rows to shapes.txt file
+                    if not update_existing:
+                        wr.writerows(zip(
+                            [shape_id] * len(lats), lats, lons, range(1, len(lats) + 1), shape_dists.tolist()))
+                    else:
+                        for shape_pt_seq, (shape_pt_lat, shape_pt_lon, shape_dist_traveled) in \
+                                enumerate(zip(lats, lons, shape_dists.tolist()), 1):
+                            # Do a little jiggering because the user's existing shapes.txt might contain extra fields and might not be in the same order
+                            row_to_add = shapes_row_template[:]
+                            row_to_add[shape_id_idx] = shape_id
+                            row_to_add[shape_pt_lat_idx] = shape_pt_lat
+                            row_to_add[shape_pt_lon_idx] = shape_pt_lon
+                            row_to_add[shape_pt_sequence_idx] = shape_pt_seq
+                            row_to_add[shape_dist_traveled_idx] = shape_dist_traveled
+                            wr.writerow(row_to_add)
+
+                if not lats or polyline.length == 0:
+                    # There's no line to linear reference the stops along
+                    shapes_with_no_geometry.append(shape_id)
+                    stop_dists = [0.0] * len(stop_ids)
+
                 else:
-                    # Do a little jiggering because the user's existing shapes.txt might contain extra fields and might not be in the same order
-                    row_to_add = ["" for col in shapes_columns]
-                    row_to_add[shape_id_idx] = shape_id
-                    row_to_add[shape_pt_lat_idx] = shape_pt_lat
-                    row_to_add[shape_pt_lon_idx] = shape_pt_lon
-                    row_to_add[shape_pt_sequence_idx] = shape_pt_seq
-                    row_to_add[shape_dist_traveled_idx] = shape_dist_traveled
-                wr.writerow(row_to_add)
-                shape_pt_seq += 1
-                previous_point = current_point
+                    # Linear reference the stops along the line
+                    native_dists = get_cumulative_planar_distances(lon_array, lat_array, part_start_array)
+                    stop_dists, out_of_order = linear_reference_stops(
+                        polyline, stop_xys, stop_point, native_dists, shape_dists)
+                    if out_of_order:
+                        shapes_with_warnings.append(shape_id)
+
+                # Preserve the linear referencing to the SQL table. If a stop is visited more than once, keep the last one.
+                c.executemany("INSERT OR REPLACE INTO stop_shape_dist VALUES (?, ?, ?);",
+                    ((shape_id, stop_id, shape_dist_traveled) for stop_id, shape_dist_traveled in zip(stop_ids, stop_dists)))
+                updated_shape_ids.add(shape_id)
 
 
         if update_existing:
             # Delete previous entries for these shapes from SQL table
-            for row in arcpy.da.SearchCursor(inShapes, ["shape_id"]):
-                delete_stmt = "DELETE FROM shapes WHERE shape_id='%s'" % row[0]
-                c.execute(delete_stmt)
+            c.executemany("DELETE FROM shapes WHERE shape_id=?;",
+                ((row[0],) for row in arcpy.da.SearchCursor(inShapes, ["shape_id"])))
             
             # Save some info about column order for later
             shapes_columns = get_table_columns("shapes")
@@ -224,22 +404,31 @@ tool. You have ArcGIS Pro version %s." % ArcVersion)
             shape_pt_lon_idx = shapes_columns.index("shape_pt_lon")
             shape_pt_sequence_idx = shapes_columns.index("shape_pt_sequence")
             shape_dist_traveled_idx = shapes_columns.index("shape_dist_traveled")
+            shapes_row_template = [""] * len(shapes_columns)
 
             # Write out the existing entries to shapes.txt
             write_SQL_table_to_text_file("shapes", outShapesFile, shapes_columns)
         
             # We'll append the updated shapes to the existing original shapes
-            mode = "ab"
+            mode = "a"
         else:
-            mode = "wb"
+            mode = "w"
+
+        # Read all the stops up front and bucket them by shape so we don't have to query the stops for each shape
+        stops_by_shape = {}  # {shape_id: [(sequence, stop_id, (x, y))]}
+        for row in arcpy.da.SearchCursor(
+                inStops_wShapeIDs, ["shape_id", "sequence", "stop_id", "SHAPE@XY"], spatial_reference=WGSCoords):
+            stops_by_shape.setdefault(row[0], []).append(row[1:])
 
         shapes_with_no_geometry = []
+        shapes_with_warnings = []
+        updated_shape_ids = set()
         # Open the new shapes.txt file and write output.
         if ProductName == "ArcGISPro":
-            with codecs.open(outShapesFile, mode, encoding="utf-8") as f:
+            with open(outShapesFile, mode, encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE) as f:
                 WriteShapesFile(f)
         else:         
-            with open(outShapesFile, mode) as f:
+            with open(outShapesFile, mode + "b") as f:
                 WriteShapesFile(f)
 
         # Add warnings for shapes that have them.
@@ -249,147 +438,6 @@ These shapes will be written to shapes.txt, and shape_dist_traveled values will
 be written to stop_times.txt, but all shape_dist_traveled values for \
 the shape will have a value of 0.0.  shape_ids affected: " + \
 str(shapes_with_no_geometry))
-
-        arcpy.AddMessage("Successfully generated new shapes.txt file.")
-
-    except:
-        arcpy.AddError("Error writing new shapes.txt file.")
-        raise
-
-
-# ----- Generate new stop_times.txt file with shape_dist_traveled field -----
-
-    arcpy.AddMessage("Creating new stop_times.txt file...")
-    arcpy.AddMessage("(This may take some time for large datasets.)")
-
-    try:
-        shapes_with_warnings = []
-        progress = 0
-        perc = 10
-        final_stoptimes_tabledata = {} # {shape_id: {stop_id: shape_dist_traveled}
-        for line in arcpy.da.SearchCursor(inShapes, ["SHAPE@", "shape_id"]):
-            # Print some progress indicators
-            progress += 1
-            if progress >= tenperc:
-                arcpy.AddMessage(str(perc) + "% finished")
-                perc += 10
-                progress = 0
-            polyline = line[0]
-            shape_id = line[1]
-            where = """"shape_id" = '%s'""" % str(shape_id)
-            StopsLayer = arcpy.management.MakeFeatureLayer(inStops_wShapeIDs, "StopsLayer", where)
-            sequence_stopid_dict = {}  # {sequence: stop_id}
-            pt_geom = {}  # {sequence: geometry object}
-            for row in arcpy.da.SearchCursor(StopsLayer, ["SHAPE@", "stop_id", "sequence"]):
-                sequence_stopid_dict[row[2]] = row[1]
-                pt_geom[row[2]] = row[0]
-
-            # Length of polyline in whatever units it natively has (doesn't matter)
-            max_measure = polyline.length
-
-            sequence_keys = [s for s in pt_geom.keys()]
-            total_pts = len(sequence_keys)
-            pt_LR = {} # {sequence: dist along line}
-            times_attempted = {pt: 0 for pt in sequence_keys}
-
-            # In a random order, linear reference the stops along the line, and try again if they end up out of sequence,
-            # until all have been addressed
-            while sequence_keys:
-                # Randomly choose one of the points in our remaining list that we still need to linear reference
-                random_pt = random.choice(sequence_keys)
-                if times_attempted[random_pt] > total_pts:
-                    # This is to cut off infinite loops.  If we've already tried this point more times than once per item in the list,
-                    # assume it's impossible to get the order correct and just give up.
-                    # Hopefully one day I can come up with a better way to deal with this case.
-                    pt_LR[random_pt] = polyline.measureOnLine(pt_geom[random_pt], use_percentage=False)
-                    sequence_keys.remove(random_pt)
-                    continue
-                times_attempted[random_pt] += 1
-                used_keys = sorted(list(pt_LR.keys()) + [random_pt])
-                this_key_idx = used_keys.index(random_pt)
-                if this_key_idx == 0: # This is in the first position
-                    # Start at the beginning
-                    line_start_dist = 0
-                else:
-                    # Start at the location of the previous point
-                    prior_key = used_keys[this_key_idx - 1]
-                    line_start_dist = pt_LR[prior_key]
-                if this_key_idx == len(used_keys) - 1: # This is in the last position
-                    # Go all the way to the end
-                    line_end_dist = max_measure
-                else:
-                    # End at the location of the next point
-                    next_key = used_keys[this_key_idx + 1]
-                    line_end_dist = pt_LR[next_key]
-
-                # Get the segment of the total polyline to use for linear referencing
-                polyline_segment = polyline.segmentAlongLine(line_start_dist, line_end_dist, use_percentage=False)
-                if polyline_segment.length == 0:
-                    # The line segment we're linear referencing along has 0 length, meaning the start and end distance is the same.
-                    # That's kind of weird and hard to interpret. Throw this point away as well as the prior and next ones and try again later.
-                    print("Found a 0-length segment!")
-                    if this_key_idx > 0:
-                        del pt_LR[prior_key]
-                        sequence_keys.append(prior_key)
-                    if this_key_idx != len(used_keys) - 1:
-                        del pt_LR[next_key]
-                        sequence_keys.append(next_key)
-                    continue
-                measure_along_segment = polyline_segment.measureOnLine(pt_geom[random_pt], use_percentage=False)
-                polyline_segment_length = polyline_segment.length
-                if this_key_idx > 0 and measure_along_segment == 0:
-                    if pt_geom[random_pt].equals(pt_geom[prior_key]):
-                        # Special case where this point is in the same location as the prior point, so this is okay, and we keep it.
-                        pt_LR[random_pt] = pt_LR[prior_key]
-                        sequence_keys.remove(random_pt)
-                        continue
-                    # This linear referenced to the very start of the line, so either this or the prior one is bad.
-                    # Remove the prior one, add it back to the list to process, and don't add this one
-                    del pt_LR[prior_key]
-                    sequence_keys.append(prior_key)
-                    continue
-                if this_key_idx != len(used_keys) - 1 and measure_along_segment == polyline_segment_length:
-                    if pt_geom[random_pt].equals(pt_geom[next_key]):
-                        # Special case where this point is in the same location as the next point, so this is okay, and we keep it.
-                        pt_LR[random_pt] = pt_LR[next_key]
-                        sequence_keys.remove(random_pt)
-                        continue
-                    # This linear referenced to the very end of the line, so either this or the next one is bad
-                    # Remove the next one, add it back to the list to process, and don't add this one
-                    del pt_LR[next_key]
-                    sequence_keys.append(next_key)
-                    continue
-
-                # Preserve the total distance long the line for this point
-                pt_LR[random_pt] = line_start_dist + measure_along_segment
-                
-                # We're done with this point, so remove it from the list to consider
-                sequence_keys.remove(random_pt)
-
-            # Convert measure distance to geodesic shape_dist_traveled for each stop_id
-            shape_dist_dict_item = {} # {stop_id: shape_dist_traveled}
-            check_sorting = []  # List to use to check that linear referencing is in the correct sequence
-            for pt in sorted(pt_LR.keys()):
-                if ProductName == "ArcGISPro":
-                    stop_id = str(sequence_stopid_dict[pt])
-                else:
-                    stop_id = unicode(sequence_stopid_dict[pt])
-                shape_dist_traveled = polyline.segmentAlongLine(0, pt_LR[pt], use_percentage=False).getLength("GEODESIC", units.upper())
-                shape_dist_dict_item[stop_id] = shape_dist_traveled
-                check_sorting.append([pt, shape_dist_traveled])
-
-            # Preserve the linear referencing to the master dictionary
-            final_stoptimes_tabledata[str(shape_id)] = shape_dist_dict_item
-
-            # Check if the stops came out in the right order. If they
-            # didn't, something is wrong with the user's input shape or the way it got linear referenced
-            # A common issue is routes that backtrack on themselves.
-            sortedList_sequence = sorted(check_sorting, key=itemgetter(0,1))
-            sortedList_dist = sorted(check_sorting, key=itemgetter(1,0))
-            if sortedList_dist != sortedList_sequence:
-                shapes_with_warnings.append(shape_id)
-
-        # Add warnings for shapes that have them.
         if shapes_with_warnings:
             arcpy.AddWarning("Warning! For some Shapes, the order of the measured \
 shape_dist_traveled for stops along the shape does not match the correct \
@@ -400,11 +448,18 @@ Please review and fix your shape geometry, then run this tool \
 again.  See the user's guide for more information.  shape_ids affected: " + \
 str(shapes_with_warnings))
 
+        arcpy.AddMessage("Successfully generated new shapes.txt file.")
+
     except:
-        arcpy.AddError("Error linear referencing stops.")
+        arcpy.AddError("Error writing new shapes.txt file and linear referencing stops.")
         raise
 
 
+# ----- Generate new stop_times.txt file with shape_dist_traveled field -----
+
+    arcpy.AddMessage("Creating new stop_times.txt file...")
+    arcpy.AddMessage("(This may take some time for large datasets.)")
+
     # Write the new stop_times.txt file
     try:
 
@@ -412,47 +467,49 @@ str(shapes_with_warnings))
             wr = csv.writer(f)
 
             # Get the columns for stop_times.txt.
-            c.execute("PRAGMA table_info(stop_times)")
-            stoptimes_table_info = c.fetchall()
-            columns = ()
-            for col in stoptimes_table_info:
-                columns += (col[1],)
+            columns = get_table_columns("stop_times")
             # Write the columns to the CSV
             wr.writerow(columns)
             # Find the column indices for things we need later
             stop_id_idx = columns.index("stop_id")
-            trip_id_idx = columns.index("trip_id")
             shape_dist_traveled_idx = columns.index("shape_dist_traveled")
 
-            # Read in the rows from the stop_times SQL table, look up the \
-            # shape_dist_traveled, and write to CSV
+            # Read in the rows from the stop_times SQL table joined with the shape_id for the trip and the
+            # shape_dist_traveled we calculated, and write to CSV. Step 1 doesn't make sure trip_ids are unique, so
+            # only take one shape_id per trip so we don't write any stop_times rows more than once.
             cst = conn.cursor()
-            selectstoptimesstmt = "SELECT * FROM stop_times;"
+            selectstoptimesstmt = '''SELECT stop_times.*, trip_shapes.shape_id, stop_shape_dist.shape_dist_traveled
+                FROM stop_times
+                LEFT JOIN (SELECT trip_id, MAX(shape_id) AS shape_id FROM trips GROUP BY trip_id) AS trip_shapes
+                    ON trip_shapes.trip_id = stop_times.trip_id
+                LEFT JOIN stop_shape_dist ON stop_shape_dist.shape_id = trip_shapes.shape_id
+                    AND stop_shape_dist.stop_id = stop_times.stop_id;'''
             cst.execute(selectstoptimesstmt)
-            for stoptime in cst:
-                # Encode in utf-8.
-                if ProductName == "ArcGISPro":
-                    stoptimelist = [t for t in stoptime]
-                else:
-                    stoptimelist = [t.encode("utf-8") if isinstance(t, basestring) else t for t in stoptime]
-                trip_id = stoptimelist[trip_id_idx]
-                # Only update shape_dist_traveled if we're doing all new shapes or if we're updating this specific shape
-                # Otherwise just skip this part and write out the row as it was already.
-                if not update_existing or (update_existing and trip_id in trip_shape_dict):
-                    shape_id = trip_shape_dict[trip_id]
-                    stop_id = stoptimelist[stop_id_idx]
-                    try:
-                        shape_dist_traveled = final_stoptimes_tabledata[shape_id][stop_id]
-                        stoptimelist[shape_dist_traveled_idx] = shape_dist_traveled
-                    except KeyError:
-                        bad_shapes_stops.append([shape_id, stop_id])
-                stoptimetuple = tuple(stoptimelist)
-                wr.writerow(stoptimetuple)
+            # Encode in utf-8 if needed.
+            if ProductName == "ArcGISPro":
+                make_row_list = list
+            else:
+                make_row_list = encode_row
+
+            def GetStopTimeRows():
+                for stoptime in cst:
+                    shape_id, shape_dist_traveled = stoptime[-2:]
+                    stoptimelist = make_row_list(stoptime[:-2])
+                    # Only update shape_dist_traveled if we're doing all new shapes or if we're updating this specific shape
+                    # Otherwise just skip this part and write out the row as it was already.
+                    if not update_existing or shape_id in updated_shape_ids:
+                        if shape_dist_traveled is None:
+                            bad_shapes_stops.append([shape_id, stoptimelist[stop_id_idx]])
+                        else:
+                            stoptimelist[shape_dist_traveled_idx] = shape_dist_traveled
+                    yield stoptimelist
+
+            wr.writerows(GetStopTimeRows())
 
         bad_shapes_stops = []
         # Open the new stop_times CSV for writing
         if ProductName == "ArcGISPro":
-            with codecs.open(outStopTimesFile, "wb", encoding="utf-8") as f:
+            with open(outStopTimesFile, "w", encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE) as f:
                 WriteStopTimesFile(f)
         else:         
             with open(outStopTimesFile, "wb") as f:
@@ -493,4 +550,6 @@ finally:
     if orig_overwrite:
         arcpy.env.overwriteOutput = orig_overwrite
     if c:
-        c.close()
\ No newline at end of file
+        c.close()
+        # Throw away the changes to the SQL tables so the user's Step 1 database is left as it was
+        conn.rollback()
\ No newline at end of file
@@ -110,34 +110,46 @@ def runTool(input_network_analyst_layer, output_feature_class, start_day_input="
         # Solve for each time of day and save output
         arcpy.AddMessage("Solving Service Area at time...")
         first = True
-        for t in timelist:
-            arcpy.AddMessage(str(t))
-            
-            # Switch the time of day
-            solverProps.timeOfDay = t
-            
-            # Solve the Service Area
-            try:
-                arcpy.na.Solve(input_network_analyst_layer)
-            except:
-                arcpy.AddError("Solve failed.")
-                arcpy.AddError(arcpy.GetMessages(2))
-                raise CustomError
-            
-            # Calculate the TimeOfDay field
-            AnalysisHelpers.calculate_TimeOfDay_field(polygons_subLayer, time_field, t)
-            
-            #Append the polygons to the output feature class. If this was the first
-            #solve, create the feature class.
-            if first:
-                arcpy.conversion.FeatureClassToFeatureClass(
-                    polygons_subLayer,
-                    os.path.dirname(output_feature_class),
-                    os.path.basename(output_feature_class)
-                    )
-            else:
-                arcpy.management.Append(polygons_subLayer, output_feature_class)
-            first = False
+        insert_cursor = None
+        try:
+            for t in timelist:
+                arcpy.AddMessage(str(t))
+
+                # Switch the time of day
+                solverProps.timeOfDay = t
+
+                # Solve the Service Area
+                try:
+                    arcpy.na.Solve(input_network_analyst_layer)
+                except:
+                    arcpy.AddError("Solve failed.")
+                    arcpy.AddError(arcpy.GetMessages(2))
+                    raise CustomError
+
+                #Append the polygons to the output feature class with the TimeOfDay field set. If this was the
+                #first solve, create the feature class and open an insert cursor on it to use for the later solves.
+                if first:
+                    arcpy.conversion.FeatureClassToFeatureClass(
+                        polygons_subLayer,
+                        os.path.dirname(output_feature_class),
+                        os.path.basename(output_feature_class)
+                        )
+                    with arcpy.da.UpdateCursor(output_feature_class, [time_field]) as cur:
+                        for row in cur:
+                            cur.updateRow([t])
+                    sublayer_field_names = [f.name for f in arcpy.ListFields(polygons_subLayer)]
+                    output_fields = ["SHAPE@"] + [f.name for f in arcpy.ListFields(output_feature_class) if \
+                        f.editable and f.type not in ["OID", "Geometry"] and f.name in sublayer_field_names and \
+                        f.name != time_field]
+                    insert_cursor = arcpy.da.InsertCursor(output_feature_class, output_fields + [time_field])
+                else:
+                    with arcpy.da.SearchCursor(polygons_subLayer, output_fields) as cur:
+                        for row in cur:
+                            insert_cursor.insertRow(row + (t,))
+                first = False
+        finally:
+            if insert_cursor is not None:
+                del insert_cursor
 
     except CustomError:
         pass